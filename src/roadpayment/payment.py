@@ -7,16 +7,30 @@ from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from decimal import Decimal
 from enum import Enum
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from typing import MutableMapping as TypingMutableMapping
+import copy
+import functools
 import hashlib
+import heapq
+import itertools
 import json
 import logging
-import secrets
+import operator
+import os
+import queue
 import threading
 import uuid
+import weakref
 
 logger = logging.getLogger(__name__)
 
+EVENTS: Tuple[str, ...] = (
+    "payment.created", "payment.completed", "payment.failed",
+    "subscription.created", "subscription.cancelled",
+    "refund.created", "refund.completed"
+)
+
 
 class Currency(str, Enum):
     USD = "USD"
@@ -56,10 +70,32 @@ class BillingInterval(str, Enum):
     YEARLY = "yearly"
 
 
-@dataclass
+_PERIOD: Dict[BillingInterval, timedelta] = {
+    BillingInterval.DAILY: timedelta(days=1),
+    BillingInterval.WEEKLY: timedelta(weeks=1),
+    BillingInterval.MONTHLY: timedelta(days=30),
+    BillingInterval.YEARLY: timedelta(days=365),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _period_delta_for(interval: BillingInterval, count: int) -> timedelta:
+    return _PERIOD[interval] * count
+
+
+@functools.lru_cache(maxsize=None)
+def _trial_delta_for(trial_days: int) -> Optional[timedelta]:
+    return timedelta(days=trial_days) if trial_days else None
+
+
+@dataclass(frozen=True, slots=True)
 class Money:
     amount: Decimal
     currency: Currency
+    _amount_str: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_amount_str", str(self.amount))
 
     def __add__(self, other: "Money") -> "Money":
         if self.currency != other.currency:
@@ -72,10 +108,10 @@ class Money:
         return Money(self.amount - other.amount, self.currency)
 
     def to_dict(self) -> Dict[str, Any]:
-        return {"amount": str(self.amount), "currency": self.currency.value}
+        return {"amount": self._amount_str, "currency": self.currency.value}
 
 
-@dataclass
+@dataclass(slots=True)
 class PaymentMethodInfo:
     id: str
     type: PaymentMethod
@@ -86,7 +122,7 @@ class PaymentMethodInfo:
     metadata: Dict[str, Any] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(slots=True)
 class Customer:
     id: str
     email: str
@@ -97,7 +133,7 @@ class Customer:
     created_at: datetime = field(default_factory=datetime.now)
 
 
-@dataclass
+@dataclass(slots=True)
 class Payment:
     id: str
     customer_id: str
@@ -110,8 +146,22 @@ class Payment:
     completed_at: Optional[datetime] = None
     error: Optional[str] = None
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "customer_id": self.customer_id,
+            "amount": self.amount.to_dict(),
+            "status": self.status.value,
+            "payment_method_id": self.payment_method_id,
+            "description": self.description,
+            "metadata": self.metadata,
+            "created_at": self.created_at.isoformat(),
+            "completed_at": self.completed_at.isoformat() if self.completed_at else None,
+            "error": self.error
+        }
 
-@dataclass
+
+@dataclass(slots=True)
 class Refund:
     id: str
     payment_id: str
@@ -121,7 +171,7 @@ class Refund:
     created_at: datetime = field(default_factory=datetime.now)
 
 
-@dataclass
+@dataclass(slots=True)
 class Plan:
     id: str
     name: str
@@ -132,8 +182,16 @@ class Plan:
     features: List[str] = field(default_factory=list)
     metadata: Dict[str, Any] = field(default_factory=dict)
 
+    @property
+    def _period_delta(self) -> timedelta:
+        return _period_delta_for(self.interval, self.interval_count)
+
+    @property
+    def _trial_delta(self) -> Optional[timedelta]:
+        return _trial_delta_for(self.trial_days)
 
-@dataclass
+
+@dataclass(slots=True)
 class Subscription:
     id: str
     customer_id: str
@@ -146,6 +204,166 @@ class Subscription:
     metadata: Dict[str, Any] = field(default_factory=dict)
 
 
+def _snapshot(data: Any) -> Any:
+    """Shallow copy of an event payload, with its own metadata dict."""
+    try:
+        snapshot = copy.copy(data)
+        if isinstance(getattr(snapshot, "metadata", None), dict):
+            snapshot.metadata = dict(snapshot.metadata)
+        return snapshot
+    except Exception as e:
+        logger.error("Hook snapshot error, passing live object: %s", e)
+        return data
+
+
+def _safe(handler: Callable) -> Callable:
+    @functools.wraps(handler)
+    def wrapper(data: Any) -> None:
+        try:
+            handler(data)
+        except Exception as e:
+            logger.error("Hook error: %s", e)
+    return wrapper
+
+
+class _HookWorker:
+    """Runs background hook handlers in order on one daemon thread."""
+
+    _STOP = object()
+
+    def __init__(self):
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="roadpayment-hooks", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                handlers, data = item
+                for handler in handlers:
+                    handler(data)
+            finally:
+                self.queue.task_done()
+
+    def put(self, handlers: Tuple[Callable, ...], data: Any) -> None:
+        self.queue.put_nowait((handlers, data))
+
+    def flush(self) -> None:
+        self.queue.join()
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put_nowait(self._STOP)
+            self.thread.join()
+
+
+class _IdPool:
+    """Hands out random hex IDs sliced from one pooled os.urandom buffer."""
+
+    __slots__ = ("buf", "pos", "lock")
+
+    SIZE = 4096
+
+    def __init__(self):
+        self.buf = b""
+        self._reset()
+
+    def _reset(self) -> None:
+        self.pos = self.SIZE
+        self.lock = threading.Lock()
+
+    def next_hex(self, n_bytes: int) -> str:
+        with self.lock:
+            if self.pos + n_bytes > self.SIZE:
+                self.buf = os.urandom(self.SIZE)
+                self.pos = 0
+            start = self.pos
+            self.pos = start + n_bytes
+            return self.buf[start:start + n_bytes].hex()
+
+
+_ID_POOL = _IdPool()
+
+if hasattr(os, "register_at_fork"):
+    # A forked child must not replay the parent's unused random bytes, nor
+    # inherit the lock in whatever state another parent thread left it.
+    os.register_at_fork(after_in_child=_ID_POOL._reset)
+
+
+_V = TypeVar("_V")
+
+
+class _ShardedMap(TypingMutableMapping[str, _V]):
+    """Mapping split into N dict shards, each with its own lock.
+
+    Reads go straight to the shard dict; writes only lock the owning shard.
+    values() and items() return snapshot lists.
+    """
+
+    __slots__ = ("_shards", "_locks", "_mask")
+
+    _MISSING = object()
+
+    def __init__(self, shards: int = 16):
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError("Shard count must be a power of two")
+        self._shards: Tuple[Dict[str, _V], ...] = tuple({} for _ in range(shards))
+        self._locks: Tuple[threading.Lock, ...] = tuple(threading.Lock() for _ in range(shards))
+        self._mask = shards - 1
+
+    def _index(self, key: str) -> int:
+        return hash(key) & self._mask
+
+    def get(self, key: str, default: Optional[_V] = None) -> Optional[_V]:
+        return self._shards[self._index(key)].get(key, default)
+
+    def __getitem__(self, key: str) -> _V:
+        return self._shards[self._index(key)][key]
+
+    def __setitem__(self, key: str, value: _V) -> None:
+        idx = self._index(key)
+        with self._locks[idx]:
+            self._shards[idx][key] = value
+
+    def __delitem__(self, key: str) -> None:
+        idx = self._index(key)
+        with self._locks[idx]:
+            del self._shards[idx][key]
+
+    def setdefault(self, key: str, default: _V) -> _V:
+        idx = self._index(key)
+        with self._locks[idx]:
+            return self._shards[idx].setdefault(key, default)
+
+    def pop(self, key: str, default: Any = _MISSING) -> Any:
+        idx = self._index(key)
+        with self._locks[idx]:
+            if default is self._MISSING:
+                return self._shards[idx].pop(key)
+            return self._shards[idx].pop(key, default)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._shards[self._index(key)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    def __iter__(self) -> Iterator[str]:
+        return itertools.chain.from_iterable(list(shard) for shard in self._shards)
+
+    def values(self) -> List[_V]:
+        return list(itertools.chain.from_iterable(list(shard.values()) for shard in self._shards))
+
+    def items(self) -> List[Tuple[str, _V]]:
+        return list(itertools.chain.from_iterable(list(shard.items()) for shard in self._shards))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+
 class PaymentProvider:
     async def charge(self, customer: Customer, amount: Money, payment_method_id: str) -> tuple:
         raise NotImplementedError
@@ -156,49 +374,91 @@ class PaymentProvider:
 
 class MockPaymentProvider(PaymentProvider):
     async def charge(self, customer: Customer, amount: Money, payment_method_id: str) -> tuple:
-        logger.info(f"Charging {amount.amount} {amount.currency.value} to {customer.email}")
-        return True, {"provider_id": secrets.token_hex(16)}
+        logger.info("Charging %s %s to %s", amount.amount, amount.currency.value, customer.email)
+        return True, {"provider_id": _ID_POOL.next_hex(16)}
 
     async def refund(self, payment_id: str, amount: Money) -> tuple:
-        logger.info(f"Refunding {amount.amount} {amount.currency.value} for {payment_id}")
-        return True, {"provider_id": secrets.token_hex(16)}
+        logger.info("Refunding %s %s for %s", amount.amount, amount.currency.value, payment_id)
+        return True, {"provider_id": _ID_POOL.next_hex(16)}
 
 
 class PaymentProcessor:
     def __init__(self, provider: PaymentProvider = None):
         self.provider = provider or MockPaymentProvider()
-        self.customers: Dict[str, Customer] = {}
-        self.payments: Dict[str, Payment] = {}
-        self.refunds: Dict[str, Refund] = {}
-        self.plans: Dict[str, Plan] = {}
-        self.subscriptions: Dict[str, Subscription] = {}
-        self.hooks: Dict[str, List[Callable]] = {
-            "payment.created": [], "payment.completed": [], "payment.failed": [],
-            "subscription.created": [], "subscription.cancelled": [],
-            "refund.created": [], "refund.completed": []
-        }
-        self._lock = threading.Lock()
-
-    def add_hook(self, event: str, handler: Callable) -> None:
-        if event in self.hooks:
-            self.hooks[event].append(handler)
+        self.customers: _ShardedMap[Customer] = _ShardedMap()
+        self.payments: _ShardedMap[Payment] = _ShardedMap()
+        self.refunds: _ShardedMap[Refund] = _ShardedMap()
+        self.plans: _ShardedMap[Plan] = _ShardedMap()
+        self.subscriptions: _ShardedMap[Subscription] = _ShardedMap()
+        self._payments_by_customer: _ShardedMap[List[str]] = _ShardedMap()
+        self.hooks: Dict[str, Tuple[Callable, ...]] = {e: () for e in EVENTS}
+        self._background_hooks: Dict[str, Tuple[Callable, ...]] = {e: () for e in EVENTS}
+        self._worker: Optional[_HookWorker] = None
+        self._worker_finalizer: Optional[weakref.finalize] = None
+        self._hooks_lock = threading.Lock()
+
+    def add_hook(self, event: str, handler: Callable, sync: bool = True) -> None:
+        """Register a handler for ``event``.
+
+        Handlers run inline by default. With ``sync=False`` they run in order
+        on a background thread and receive a snapshot of the object as it was
+        when the event fired.
+        """
+        if event not in self.hooks:
+            return
+        with self._hooks_lock:
+            if sync:
+                self.hooks[event] = self.hooks[event] + (_safe(handler),)
+                return
+            self._background_hooks[event] = self._background_hooks[event] + (_safe(handler),)
+            if self._worker is None:
+                self._worker = _HookWorker()
+                # Drains queued events when the processor is collected or at exit.
+                self._worker_finalizer = weakref.finalize(self, self._worker.close)
+
+    def flush(self) -> None:
+        """Block until every queued background hook has run."""
+        worker = self._worker
+        if worker is not None:
+            worker.flush()
+
+    def close(self) -> None:
+        """Run any queued background hooks, then stop the worker thread.
+
+        Later events run background hooks inline until another background
+        hook is registered, which starts a new worker.
+        """
+        with self._hooks_lock:
+            finalizer, self._worker, self._worker_finalizer = self._worker_finalizer, None, None
+        if finalizer is not None:
+            finalizer()
 
     def _emit(self, event: str, data: Any) -> None:
-        for handler in self.hooks.get(event, []):
-            try:
-                handler(data)
-            except Exception as e:
-                logger.error(f"Hook error: {e}")
+        for handler in self.hooks.get(event, ()):
+            handler(data)
+        handlers = self._background_hooks.get(event)
+        if not handlers:
+            return
+        snapshot = _snapshot(data)
+        # Holding the lock keeps close() from queueing its stop sentinel
+        # between reading the worker and queueing this event.
+        with self._hooks_lock:
+            worker = self._worker
+            if worker is not None:
+                worker.put(handlers, snapshot)
+                return
+        for handler in handlers:
+            handler(data)
 
     def create_customer(self, email: str, name: str = "", **metadata) -> Customer:
         customer = Customer(
-            id=f"cus_{secrets.token_hex(8)}",
+            id=f"cus_{_ID_POOL.next_hex(8)}",
             email=email,
             name=name,
-            metadata=metadata
+            metadata=metadata,
+            created_at=datetime.now()
         )
-        with self._lock:
-            self.customers[customer.id] = customer
+        self.customers[customer.id] = customer
         return customer
 
     def get_customer(self, customer_id: str) -> Optional[Customer]:
@@ -210,7 +470,7 @@ class PaymentProcessor:
             return None
         
         method = PaymentMethodInfo(
-            id=f"pm_{secrets.token_hex(8)}",
+            id=f"pm_{_ID_POOL.next_hex(8)}",
             type=method_type,
             **kwargs
         )
@@ -228,16 +488,18 @@ class PaymentProcessor:
         if not pm_id:
             raise ValueError("No payment method")
         
+        now = datetime.now()
         payment = Payment(
-            id=f"pay_{secrets.token_hex(8)}",
+            id=f"pay_{_ID_POOL.next_hex(8)}",
             customer_id=customer_id,
             amount=Money(amount, currency),
             payment_method_id=pm_id,
-            description=description
+            description=description,
+            created_at=now
         )
         
-        with self._lock:
-            self.payments[payment.id] = payment
+        self.payments[payment.id] = payment
+        self._payments_by_customer.setdefault(customer_id, []).append(payment.id)
         self._emit("payment.created", payment)
         
         payment.status = PaymentStatus.PROCESSING
@@ -263,14 +525,14 @@ class PaymentProcessor:
         refund_amount = Money(amount or payment.amount.amount, payment.amount.currency)
         
         refund = Refund(
-            id=f"ref_{secrets.token_hex(8)}",
+            id=f"ref_{_ID_POOL.next_hex(8)}",
             payment_id=payment_id,
             amount=refund_amount,
-            reason=reason
+            reason=reason,
+            created_at=datetime.now()
         )
         
-        with self._lock:
-            self.refunds[refund.id] = refund
+        self.refunds[refund.id] = refund
         self._emit("refund.created", refund)
         
         success, result = await self.provider.refund(payment_id, refund_amount)
@@ -286,14 +548,13 @@ class PaymentProcessor:
 
     def create_plan(self, name: str, amount: Decimal, currency: Currency, interval: BillingInterval, **kwargs) -> Plan:
         plan = Plan(
-            id=f"plan_{secrets.token_hex(8)}",
+            id=f"plan_{_ID_POOL.next_hex(8)}",
             name=name,
             amount=Money(amount, currency),
             interval=interval,
             **kwargs
         )
-        with self._lock:
-            self.plans[plan.id] = plan
+        self.plans[plan.id] = plan
         return plan
 
     def create_subscription(self, customer_id: str, plan_id: str) -> Optional[Subscription]:
@@ -304,19 +565,19 @@ class PaymentProcessor:
             return None
         
         now = datetime.now()
-        period_end = self._calculate_period_end(now, plan.interval, plan.interval_count)
-        trial_end = now + timedelta(days=plan.trial_days) if plan.trial_days else None
+        period_end = now + plan._period_delta
+        trial_end = now + plan._trial_delta if plan._trial_delta else None
         
         subscription = Subscription(
-            id=f"sub_{secrets.token_hex(8)}",
+            id=f"sub_{_ID_POOL.next_hex(8)}",
             customer_id=customer_id,
             plan_id=plan_id,
+            current_period_start=now,
             current_period_end=period_end,
             trial_end=trial_end
         )
         
-        with self._lock:
-            self.subscriptions[subscription.id] = subscription
+        self.subscriptions[subscription.id] = subscription
         self._emit("subscription.created", subscription)
         
         return subscription
@@ -331,21 +592,34 @@ class PaymentProcessor:
         self._emit("subscription.cancelled", subscription)
         return True
 
-    def _calculate_period_end(self, start: datetime, interval: BillingInterval, count: int) -> datetime:
-        if interval == BillingInterval.DAILY:
-            return start + timedelta(days=count)
-        elif interval == BillingInterval.WEEKLY:
-            return start + timedelta(weeks=count)
-        elif interval == BillingInterval.MONTHLY:
-            return start + timedelta(days=30 * count)
+    def list_payments(self, customer_id: str = None, limit: Optional[int] = None) -> List[Payment]:
+        if limit is not None and limit < 0:
+            raise ValueError("limit must be non-negative")
+        if customer_id:
+            payments = [self.payments[pid] for pid in self._payments_by_customer.get(customer_id, ())]
         else:
-            return start + timedelta(days=365 * count)
+            payments = list(self.payments.values())
+        if limit is not None and limit < len(payments) // 2:
+            return heapq.nlargest(limit, payments, key=operator.attrgetter("created_at"))
+        return sorted(payments, key=operator.attrgetter("created_at"), reverse=True)[:limit]
 
-    def list_payments(self, customer_id: str = None) -> List[Payment]:
-        payments = list(self.payments.values())
+    def totals_by_currency(self, customer_id: str = None) -> Dict[Currency, Money]:
+        """Sum COMPLETED payments per currency.
+
+        Failed payments are skipped, and so are refunded ones: any refund,
+        even a partial one, marks the whole payment REFUNDED.
+        """
         if customer_id:
-            payments = [p for p in payments if p.customer_id == customer_id]
-        return sorted(payments, key=lambda p: p.created_at, reverse=True)
+            pids = self._payments_by_customer.get(customer_id, ())
+        else:
+            pids = list(self.payments)
+        totals: Dict[Currency, Decimal] = {}
+        for pid in pids:
+            payment = self.payments[pid]
+            if payment.status == PaymentStatus.COMPLETED:
+                currency = payment.amount.currency
+                totals[currency] = totals.get(currency, Decimal(0)) + payment.amount.amount
+        return {currency: Money(total, currency) for currency, total in totals.items()}
 
 
 async def example_usage():
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import random
+import threading
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from roadpayment.payment import (
+    Currency, MockPaymentProvider, Money, PaymentMethod, PaymentProcessor, PaymentStatus, _ShardedMap
+)
+
+
+class LockingProvider(MockPaymentProvider):
+    async def charge(self, customer, amount, payment_method_id):
+        return True, {"lock": threading.Lock()}
+
+
+class FailingProvider(MockPaymentProvider):
+    async def charge(self, customer, amount, payment_method_id):
+        return False, {"error": "card declined"}
+
+
+class ShardedMapTest(unittest.TestCase):
+    def setUp(self):
+        self.data = {f"key_{i}": i for i in range(100)}
+        self.map = _ShardedMap()
+        self.map.update(self.data)
+
+    def test_len_and_iteration(self):
+        self.assertEqual(len(self.map), 100)
+        self.assertEqual(sorted(self.map), sorted(self.data))
+        self.assertIn("key_42", self.map)
+        self.assertNotIn("missing", self.map)
+
+    def test_values_and_items_are_snapshots(self):
+        values = self.map.values()
+        items = self.map.items()
+        self.map["key_100"] = 100
+        del self.map["key_0"]
+        self.assertEqual(sorted(values), list(range(100)))
+        self.assertEqual(dict(items), self.data)
+
+    def test_pop(self):
+        self.assertEqual(self.map.pop("key_1"), 1)
+        self.assertNotIn("key_1", self.map)
+        self.assertIsNone(self.map.pop("key_1", None))
+        with self.assertRaises(KeyError):
+            self.map.pop("key_1")
+
+    def test_setdefault(self):
+        first = self.map.setdefault("list", [])
+        first.append(1)
+        self.assertIs(self.map.setdefault("list", []), first)
+        self.assertEqual(self.map.setdefault("key_5", -1), 5)
+
+    def test_equals_dict(self):
+        self.assertEqual(self.map, self.data)
+        self.map["key_0"] = -1
+        self.assertNotEqual(self.map, self.data)
+
+    def test_rejects_non_power_of_two_shards(self):
+        for shards in (0, 3, 12):
+            with self.assertRaises(ValueError):
+                _ShardedMap(shards)
+        self.assertEqual(len(_ShardedMap(1)), 0)
+
+
+class HookDispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.processor = PaymentProcessor()
+        self.customer = self.processor.create_customer("alice@example.com", "Alice")
+        self.processor.add_payment_method(self.customer.id, PaymentMethod.CARD)
+
+    def tearDown(self):
+        self.processor.close()
+
+    def pay(self, amount="10.00"):
+        return asyncio.run(self.processor.create_payment(self.customer.id, Decimal(amount), Currency.USD))
+
+    def test_hooks_run_inline_by_default(self):
+        seen = []
+        self.processor.add_hook(
+            "payment.created", lambda p: seen.append((p.status, threading.current_thread()))
+        )
+        self.pay()
+        self.assertEqual(seen, [(PaymentStatus.PENDING, threading.main_thread())])
+
+    def test_background_hooks_run_in_order(self):
+        seen = []
+        self.processor.add_hook("payment.created", lambda p: seen.append(("created", p.id)), sync=False)
+        self.processor.add_hook("payment.completed", lambda p: seen.append(("completed", p.id)), sync=False)
+        ids = [self.pay(str(i)).id for i in range(5)]
+        self.processor.flush()
+        expected = [(event, pid) for pid in ids for event in ("created", "completed")]
+        self.assertEqual(seen, expected)
+
+    def test_background_hooks_get_snapshot(self):
+        seen = []
+        self.processor.add_hook("payment.created", lambda p: seen.append((p.status, dict(p.metadata))), sync=False)
+        payment = self.pay()
+        self.processor.flush()
+        self.assertEqual(payment.status, PaymentStatus.COMPLETED)
+        self.assertEqual(seen, [(PaymentStatus.PENDING, {})])
+
+    def test_background_snapshot_allows_uncopyable_metadata(self):
+        seen = []
+        self.processor.provider = LockingProvider()
+        self.processor.add_hook("payment.completed", lambda p: seen.append(p), sync=False)
+        payment = self.pay()
+        self.processor.flush()
+        self.assertEqual(payment.status, PaymentStatus.COMPLETED)
+        self.assertEqual(len(seen), 1)
+        self.assertIsNot(seen[0], payment)
+        self.assertIs(seen[0].metadata["lock"], payment.metadata["lock"])
+        payment.metadata["later"] = True
+        self.assertNotIn("later", seen[0].metadata)
+
+    def test_close_while_emitting_drops_nothing(self):
+        seen = []
+        self.processor.add_hook("payment.created", lambda p: seen.append(p.id), sync=False)
+        emitted = []
+
+        def emit():
+            for i in range(2000):
+                self.processor._emit("payment.created", self.processor.get_customer(self.customer.id))
+                emitted.append(i)
+
+        thread = threading.Thread(target=emit)
+        thread.start()
+        self.processor.close()
+        thread.join()
+        self.processor.close()
+        self.assertEqual(len(seen), len(emitted))
+
+    def test_sync_hooks_run_before_background_hooks(self):
+        seen = []
+        self.processor.add_hook("payment.created", lambda p: seen.append("background"), sync=False)
+        self.processor.add_hook("payment.created", lambda p: seen.append("sync"))
+        self.pay()
+        self.processor.flush()
+        self.assertEqual(seen, ["sync", "background"])
+
+    def test_hook_errors_are_isolated(self):
+        seen = []
+        self.processor.add_hook("payment.created", lambda p: 1 / 0, sync=False)
+        self.processor.add_hook("payment.created", lambda p: seen.append(p.id), sync=False)
+        with self.assertLogs("roadpayment.payment", level="ERROR"):
+            payment = self.pay()
+            self.processor.flush()
+        self.assertEqual(seen, [payment.id])
+
+    def test_close_drains_queue_and_stops_worker(self):
+        seen = []
+        self.processor.add_hook("payment.completed", lambda p: seen.append(p.id), sync=False)
+        worker = self.processor._worker
+        ids = [self.pay().id for _ in range(3)]
+        self.processor.close()
+        self.assertEqual(seen, ids)
+        self.assertFalse(worker.thread.is_alive())
+
+        payment = self.pay()
+        self.assertEqual(seen[-1], payment.id)
+        self.processor.close()
+
+    def test_no_worker_without_background_hooks(self):
+        before = threading.active_count()
+        self.processor.add_hook("payment.created", lambda p: None)
+        self.pay()
+        self.assertIsNone(self.processor._worker)
+        self.assertEqual(threading.active_count(), before)
+
+
+class SerializationTest(unittest.TestCase):
+    def test_money_to_dict(self):
+        cases = [
+            (Decimal("99.99"), "99.99"),
+            (Decimal("10.500"), "10.500"),
+            (10, "10"),
+            (10.5, "10.5"),
+        ]
+        for amount, expected in cases:
+            self.assertEqual(Money(amount, Currency.EUR).to_dict(), {"amount": expected, "currency": "EUR"})
+        self.assertEqual(str(Money(Decimal(1), Currency.USD).to_dict()["currency"]), "USD")
+
+    def test_money_cached_string_follows_arithmetic(self):
+        total = Money(Decimal("1.10"), Currency.USD) + Money(Decimal("2.25"), Currency.USD)
+        self.assertEqual(total.to_dict()["amount"], "3.35")
+        self.assertEqual(total, Money(Decimal("3.35"), Currency.USD))
+
+    def test_payment_to_dict(self):
+        processor = PaymentProcessor()
+        customer = processor.create_customer("alice@example.com")
+        method = processor.add_payment_method(customer.id, PaymentMethod.CARD)
+        payment = asyncio.run(processor.create_payment(customer.id, 10, Currency.USD, description="Pro"))
+        data = payment.to_dict()
+        self.assertEqual(data, {
+            "id": payment.id,
+            "customer_id": customer.id,
+            "amount": {"amount": "10", "currency": "USD"},
+            "status": "completed",
+            "payment_method_id": method.id,
+            "description": "Pro",
+            "metadata": payment.metadata,
+            "created_at": payment.created_at.isoformat(),
+            "completed_at": payment.completed_at.isoformat(),
+            "error": None,
+        })
+        self.assertIs(type(data["status"]), str)
+        self.assertEqual(json.loads(json.dumps(data)), data)
+
+    def test_failed_payment_to_dict(self):
+        processor = PaymentProcessor(FailingProvider())
+        customer = processor.create_customer("alice@example.com")
+        processor.add_payment_method(customer.id, PaymentMethod.CARD)
+        data = asyncio.run(processor.create_payment(customer.id, Decimal("5.00"), Currency.GBP)).to_dict()
+        self.assertEqual(data["status"], "failed")
+        self.assertEqual(data["error"], "card declined")
+        self.assertIsNone(data["completed_at"])
+        self.assertEqual(data["amount"], {"amount": "5.00", "currency": "GBP"})
+
+
+class ListPaymentsTest(unittest.TestCase):
+    def setUp(self):
+        self.processor = PaymentProcessor()
+        self.alice = self.processor.create_customer("alice@example.com")
+        self.bob = self.processor.create_customer("bob@example.com")
+        for customer in (self.alice, self.bob):
+            self.processor.add_payment_method(customer.id, PaymentMethod.CARD)
+        start = datetime(2024, 1, 1)
+        offsets = list(range(40))
+        random.Random(7).shuffle(offsets)
+        for i, offset in enumerate(offsets):
+            customer = self.alice if i % 2 else self.bob
+            payment = asyncio.run(self.processor.create_payment(customer.id, Decimal(i), Currency.USD))
+            payment.created_at = start + timedelta(minutes=offset)
+
+    def test_newest_first(self):
+        payments = self.processor.list_payments()
+        self.assertEqual(len(payments), 40)
+        self.assertEqual([p.created_at for p in payments], sorted((p.created_at for p in payments), reverse=True))
+
+    def test_heap_and_sort_paths_agree(self):
+        full = self.processor.list_payments()
+        # limit < len // 2 takes the heap path, the rest sort and slice.
+        for limit in (1, 5, 19, 20, 39, 40, 100):
+            self.assertEqual(self.processor.list_payments(limit=limit), full[:limit])
+
+    def test_limit_zero(self):
+        self.assertEqual(self.processor.list_payments(limit=0), [])
+        self.assertEqual(self.processor.list_payments(self.alice.id, limit=0), [])
+
+    def test_negative_limit(self):
+        with self.assertRaises(ValueError):
+            self.processor.list_payments(limit=-1)
+
+    def test_customer_filter(self):
+        full = self.processor.list_payments(self.alice.id)
+        self.assertEqual(len(full), 20)
+        self.assertTrue(all(p.customer_id == self.alice.id for p in full))
+        self.assertEqual(full, [p for p in self.processor.list_payments() if p.customer_id == self.alice.id])
+        for limit in (3, 10, 20, 25):
+            self.assertEqual(self.processor.list_payments(self.alice.id, limit=limit), full[:limit])
+        self.assertEqual(self.processor.list_payments("cus_unknown"), [])
+
+
+class TotalsByCurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.processor = PaymentProcessor()
+        self.alice = self.customer("alice@example.com")
+        self.bob = self.customer("bob@example.com")
+
+    def customer(self, email):
+        customer = self.processor.create_customer(email)
+        self.processor.add_payment_method(customer.id, PaymentMethod.CARD)
+        return customer
+
+    def pay(self, customer, amount, currency=Currency.USD):
+        return asyncio.run(self.processor.create_payment(customer.id, Decimal(amount), currency))
+
+    def test_sums_per_currency(self):
+        self.pay(self.alice, "10.005")
+        self.pay(self.alice, "2.50")
+        self.pay(self.bob, "0.1", Currency.BTC)
+        self.assertEqual(self.processor.totals_by_currency(), {
+            Currency.USD: Money(Decimal("12.505"), Currency.USD),
+            Currency.BTC: Money(Decimal("0.1"), Currency.BTC),
+        })
+
+    def test_int_amounts(self):
+        asyncio.run(self.processor.create_payment(self.alice.id, 5, Currency.USD))
+        self.assertEqual(self.processor.totals_by_currency()[Currency.USD].amount, 5)
+
+    def test_customer_filter(self):
+        self.pay(self.alice, "1.00")
+        self.pay(self.bob, "2.00")
+        self.assertEqual(self.processor.totals_by_currency(self.bob.id), {Currency.USD: Money(Decimal("2.00"), Currency.USD)})
+        self.assertEqual(self.processor.totals_by_currency("cus_unknown"), {})
+
+    def test_excludes_failed_and_refunded(self):
+        self.pay(self.alice, "1.00")
+        refunded = self.pay(self.alice, "20.00")
+        asyncio.run(self.processor.create_refund(refunded.id, Decimal("5.00")))
+        self.processor.provider = FailingProvider()
+        failed = self.pay(self.alice, "300.00")
+        self.assertEqual(refunded.status, PaymentStatus.REFUNDED)
+        self.assertEqual(failed.status, PaymentStatus.FAILED)
+        self.assertEqual(self.processor.totals_by_currency(self.alice.id), {Currency.USD: Money(Decimal("1.00"), Currency.USD)})
+
+
+if __name__ == "__main__":
+    unittest.main()